@@ -1,3 +1,4 @@
+import io
 import os
 import xml.etree.ElementTree as ET
 from datetime import datetime
@@ -7,6 +8,8 @@ import threading
 
 import Time_Handler
 import HTTP_Handler
+import Status_Handler
+import Profile_Handler
 
 
 class ServerUnavailableException(Exception):
@@ -33,6 +36,10 @@ class DistributedSocialNetworkResponse:
     logger = logging.getLogger('response')
     logging.basicConfig(level=logging.INFO)
 
+    # Responses are handled on separate threads, so downloads into the friend cache are locked per destination file
+    download_locks = {}
+    download_locks_lock = threading.Lock()
+
     def __init__(self, http_method, path, ip_address, data, port, file_locations, resources_dir):
         self.http_method = http_method
         self.path = path
@@ -79,20 +86,25 @@ class DistributedSocialNetworkResponse:
 
             # Read status file and insert new status
             status_xml_path = f"{self.resources_dir}{self.file_locations['status_xml']}"
-            status_xml = ET.parse(status_xml_path)
+            with Profile_Handler.span('parse status.xml'):
+                status_xml = ET.parse(status_xml_path)
             root = status_xml.getroot()
             root.insert(0, status_element)
-            status_xml.write(status_xml_path)
+            with Profile_Handler.span('write status.xml'):
+                status_xml.write(status_xml_path)
+                self.write_statuses_json(root)
 
     def generate_friends_html(self):
         # generate a ul list of information from each friend
-        friends_list_node = self.generate_friends_list_node()
+        with Profile_Handler.span('generate friends list'):
+            friends_list_node = self.generate_friends_list_node()
         html_dom = ET.parse(self.path)
         root = html_dom.getroot()
 
         # Put friends list element into the html document
         root.find(".//div[@id='friends_info']").append(friends_list_node)
-        html_string = ET.tostring(root, encoding='UTF-8', method='html')
+        with Profile_Handler.span('serialize friends.html'):
+            html_string = ET.tostring(root, encoding='UTF-8', method='html')
         return html_string
 
     def generate_friends_list_node(self):
@@ -107,13 +119,16 @@ class DistributedSocialNetworkResponse:
         threads = []
         for friend in friends_xml.findall('friend'):
             friend_ul_element = ET.SubElement(all_friends_ul_element, 'ul')
-            populate_friend_data_thread = threading.Thread(target=self.populate_friend_ul_element,
+            populate_friend_ul_element = Profile_Handler.propagate(self.populate_friend_ul_element,
+                                                                  f"friend {friend.find('ip_address').text}")
+            populate_friend_data_thread = threading.Thread(target=populate_friend_ul_element,
                                                            args=(friend, friend_ul_element))
             threads.append(populate_friend_data_thread)
             populate_friend_data_thread.start()
 
-        for thread in threads:
-            thread.join()
+        with Profile_Handler.span('join friend threads'):
+            for thread in threads:
+                thread.join()
 
         return all_friends_ul_element
 
@@ -121,7 +136,7 @@ class DistributedSocialNetworkResponse:
         ip_address = friend.find('ip_address').text
 
         # Access friend server to get status info and profile picture
-        friend_data_available, friend_online, friend_profile_picture_path, friend_status_element = \
+        friend_data_available, friend_online, friend_profile_picture_path, friend_status = \
             self.access_friend_server(ip_address)
 
         # Add profile picture
@@ -133,40 +148,42 @@ class DistributedSocialNetworkResponse:
         self.add_friend_data_li(friend, friend_ul_element, 'name')
 
         # Add status text
-        self.add_friend_data_li(friend_status_element, friend_ul_element, 'status_text')
+        self.add_friend_status_li(friend_status, friend_ul_element, 'status_text')
 
         self.add_friend_server_status_li(friend_ul_element, friend_online, friend_data_available)
 
         if friend_data_available:
             # Add timestamp
-            timestamp = self.add_friend_data_li(friend_status_element, friend_ul_element, 'timestamp')
+            timestamp = self.add_friend_status_li(friend_status, friend_ul_element, 'timestamp')
 
             # Add likes count
             likes_li_element = ET.SubElement(friend_ul_element, 'li')
             likes_li_element.attrib = {'class': 'likes'}
-            likes_li_element.text = f"Likes: {len(list(friend_status_element.find('likes')))}"
+            likes_li_element.text = f"Likes: {friend_status['likes']['count']}"
 
             # Add like button
-            self.add_like_button(friend_status_element, friend_ul_element, ip_address, timestamp, friend_online)
+            self.add_like_button(friend_status, friend_ul_element, ip_address, timestamp, friend_online)
 
     def access_friend_server(self, ip_address):
         try:
-            friend_status_element, friend_online = self.get_friend_status_element(ip_address)
-            friend_profile_picture_path = self.update_friend_profile_picture(ip_address, friend_online)
+            with Profile_Handler.span('get friend status'):
+                friend_status, friend_online = self.get_friend_status(ip_address)
+            with Profile_Handler.span('update friend profile picture'):
+                friend_profile_picture_path = self.update_friend_profile_picture(ip_address, friend_online)
             friend_data_available = True
         except (NotFriendException,
                 ServerUnavailableException,
                 FriendHasNoStatusException,
                 ServerMissingFileException) as e:
             DistributedSocialNetworkResponse.logger.debug(e)
-            friend_status_element = self.get_exception_status_element(str(e))
+            friend_status = self.get_exception_status(str(e))
             friend_profile_picture_path = 'profile-blank.jpg'
             friend_data_available = False
             if isinstance(e, ServerUnavailableException):
                 friend_online = False
             else:
                 friend_online = True
-        return friend_data_available, friend_online, friend_profile_picture_path, friend_status_element
+        return friend_data_available, friend_online, friend_profile_picture_path, friend_status
 
     @staticmethod
     def add_friend_server_status_li(friend_ul_element, friend_online, friend_data_available):
@@ -190,7 +207,14 @@ class DistributedSocialNetworkResponse:
         status_li_element.text = node_text
         return node_text
 
-    def add_like_button(self, friend_status_element, friend_ul_element, ip_address, timestamp, friend_online):
+    @staticmethod
+    def add_friend_status_li(friend_status, ul_to_add_to, key):
+        status_li_element = ET.SubElement(ul_to_add_to, 'li')
+        status_li_element.attrib = {'class': key}
+        status_li_element.text = friend_status[key]
+        return friend_status[key]
+
+    def add_like_button(self, friend_status, friend_ul_element, ip_address, timestamp, friend_online):
         like_button_li_element = ET.SubElement(friend_ul_element, 'li')
         like_button_form_element = ET.SubElement(like_button_li_element, 'form')
         like_button_form_element.attrib = {'action': self.file_locations['friends_html'], 'method': 'POST'}
@@ -203,7 +227,7 @@ class DistributedSocialNetworkResponse:
         like_button_hidden_timestamp_element.attrib = {'type': 'hidden', 'name': 'timestamp', 'value': timestamp}
 
         like_button_button_element = ET.SubElement(like_button_form_element, 'input')
-        should_disable = self.disable_button_if_already_liked(friend_status_element.find('likes'),
+        should_disable = self.disable_button_if_already_liked(friend_status['likes']['ip_addresses'],
                                                               ip_address,
                                                               friend_online)
         like_button_attributes = {'type': 'submit', 'name': 'like',
@@ -212,32 +236,40 @@ class DistributedSocialNetworkResponse:
         like_button_attributes.update(should_disable)
         like_button_button_element.attrib = like_button_attributes
 
-    def get_friend_status_element(self, ip_address):
-        cached_friend_status_path, cached_friend_status_path_in_resources = self.get_paths(ip_address, "status.xml")
+    def get_friend_status(self, ip_address):
+        cached_friend_status_path, cached_friend_status_path_in_resources = self.get_paths(ip_address, "status.json")
         cache_modified_time = self.get_modification_time(cached_friend_status_path_in_resources)
-        friend_online, friend_statuses_xml_string_encoded, is_modified = \
+        friend_online, friend_statuses_encoded, content_type, is_modified = \
             self.request_friend_statuses(cache_modified_time, ip_address)
 
         if is_modified:
+            # Friend servers that predate the json api still send status.xml, so convert it to the same form
+            with Profile_Handler.span(f"parse statuses ({content_type})"):
+                if Status_Handler.is_json_content_type(content_type):
+                    friend_statuses = Status_Handler.statuses_from_json(friend_statuses_encoded)
+                else:
+                    friend_statuses = [Status_Handler.status_element_to_dict(status_element) for status_element in
+                                       ET.fromstring(friend_statuses_encoded.decode()).findall('status')]
             # Cache the new information
-            friend_statuses_xml_string = friend_statuses_xml_string_encoded.decode()
-            friend_latest_statuses_xml = ET.fromstring(friend_statuses_xml_string)
             try:
-                friend_latest_status = friend_latest_statuses_xml[0]
-                ET.ElementTree(friend_latest_status).write(cached_friend_status_path_in_resources)
+                friend_latest_status = friend_statuses[0]
+                with Profile_Handler.span('write cached status'):
+                    Status_Handler.write_status_json(friend_latest_status, cached_friend_status_path_in_resources)
             except IndexError:
                 raise FriendHasNoStatusException
         else:
             # Use the cached information
-            friend_latest_status = ET.parse(cached_friend_status_path_in_resources).getroot()
+            with Profile_Handler.span('read cached status'):
+                friend_latest_status = Status_Handler.read_status_json(cached_friend_status_path_in_resources)
         return friend_latest_status, friend_online
 
     def request_friend_statuses(self, cache_modified_time, ip_address):
         try:
-            friend_statuses_xml_string_encoded, is_modified = \
+            friend_statuses_encoded, is_modified, content_type = \
                 self.request_friend_data(ip_address,
                                          self.file_locations['status_xml'],
-                                         modified_time=cache_modified_time)
+                                         modified_time=cache_modified_time,
+                                         accept=Status_Handler.json_mime_type)
             friend_online = True
         except ServerUnavailableException as e:
             # If no cached version, pass error along
@@ -245,29 +277,104 @@ class DistributedSocialNetworkResponse:
                 raise e
             # Otherwise, use cached version
             else:
-                friend_statuses_xml_string_encoded = None
+                friend_statuses_encoded = None
+                content_type = None
                 friend_online = False
                 is_modified = False
-        return friend_online, friend_statuses_xml_string_encoded, is_modified
+        return friend_online, friend_statuses_encoded, content_type, is_modified
 
     def update_friend_profile_picture(self, ip_address, friend_online):
         friend_picture_file_path, friend_picture_file_path_in_resources = self.get_paths(ip_address, "picture.jpg")
-        modified_time = self.get_modification_time(friend_picture_file_path_in_resources)
 
         if friend_online:
-            friend_profile_picture_data, is_modified = self.request_friend_data(ip_address,
-                                                                                self.file_locations['profile_picture'],
-                                                                                modified_time=modified_time)
-        else:
-            friend_profile_picture_data = None
-            is_modified = False
-
-        if is_modified:
-            with open(friend_picture_file_path_in_resources, 'wb') as file:
-                file.write(friend_profile_picture_data)
+            self.download_friend_file_once(ip_address,
+                                           self.file_locations['profile_picture'],
+                                           friend_picture_file_path_in_resources)
 
+        # A first download that was interrupted leaves no picture to show yet
+        if not os.path.isfile(friend_picture_file_path_in_resources):
+            return 'profile-blank.jpg'
         return friend_picture_file_path
 
+    def download_friend_file_once(self, ip_address, file_path, destination_path):
+        with DistributedSocialNetworkResponse.download_locks_lock:
+            download_lock = DistributedSocialNetworkResponse.download_locks.setdefault(destination_path,
+                                                                                    threading.Lock())
+        if not download_lock.acquire(blocking=False):
+            # Another request is already downloading this file, wait for it and use the file it leaves behind
+            with Profile_Handler.span(f"wait for download of {os.path.basename(destination_path)}"):
+                with download_lock:
+                    return
+        try:
+            self.download_friend_file(ip_address, file_path, destination_path)
+        finally:
+            download_lock.release()
+
+    def download_friend_file(self, ip_address, file_path, destination_path):
+        # The file is streamed into a temporary file next to the destination. If the connection drops, the part
+        # already received is kept and the next download asks only for the rest
+        partial_path = f"{destination_path}.part"
+        header_fields = {}
+        partial_size = os.path.getsize(partial_path) if os.path.isfile(partial_path) else 0
+        if partial_size > 0:
+            header_fields["Range"] = f"bytes={partial_size}-"
+            # The partial file was given the modification time the friend server reported for the file
+            header_fields["If-Range"] = Time_Handler.get_formatted_str_of_file_modification_time(partial_path)
+        active_socket, header, received_data = \
+            self.send_friend_request(ip_address,
+                                     file_path,
+                                     modified_time=self.get_modification_time(destination_path),
+                                     header_fields=header_fields)
+
+        status, response_header_fields = HTTP_Handler.parse_response_header(header)
+        if "416" == status['code']:
+            # The partial file no longer fits the friend's file, start again next time
+            active_socket.close()
+            if os.path.isfile(partial_path):
+                os.remove(partial_path)
+            return
+        try:
+            is_modified, _ = self.check_header_for_modification_and_problems(header)
+        except (NotFriendException, ServerMissingFileException) as e:
+            active_socket.close()
+            raise e
+        if not is_modified:
+            active_socket.close()
+            return
+
+        # A 200 response means the friend sent the whole file, so anything received before is discarded
+        file_mode = 'ab' if "206" == status['code'] else 'wb'
+        download_interrupted = False
+        try:
+            with Profile_Handler.span(f"write {os.path.basename(partial_path)}"):
+                with open(partial_path, file_mode) as file:
+                    HTTP_Handler.retrieve_http_response_body_to_file(active_socket, file, received_data)
+        except OSError as e:
+            DistributedSocialNetworkResponse.logger.info(f"download of {file_path} from {ip_address} interrupted: {e}")
+            download_interrupted = True
+
+        if not os.path.isfile(partial_path):
+            return
+        if 'Last-Modified' in response_header_fields:
+            Time_Handler.set_file_modification_time(partial_path, response_header_fields['Last-Modified'])
+        if not download_interrupted and self.is_download_complete(status, response_header_fields, partial_path):
+            os.replace(partial_path, destination_path)
+
+    @staticmethod
+    def is_download_complete(status, header_fields, partial_path):
+        try:
+            if "206" == status['code']:
+                expected_file_size = int(header_fields['Content-Range'].rpartition('/')[2])
+            elif 'Content-Length' in header_fields:
+                expected_file_size = int(header_fields['Content-Length'])
+            else:
+                # Older friend servers do not send a length, so the file is assumed complete once the connection closes
+                return True
+        except (KeyError, ValueError):
+            # Without a usable length the file cannot be checked, so it is left to be downloaded again
+            return False
+        return os.path.getsize(partial_path) == expected_file_size
+
     def get_paths(self, ip_address, name):
         path = f"{self.file_locations['cached_friend_data_dir']}/{ip_address}_{name}"
         path_in_resources = f"{self.resources_dir}{path}"
@@ -281,47 +388,65 @@ class DistributedSocialNetworkResponse:
             modified_time = None
         return modified_time
 
-    def request_friend_data(self, ip_address, file_path, modified_time=None):
+    def request_friend_data(self, ip_address, file_path, modified_time=None, accept=None):
         header_fields = {}
+        if accept is not None:
+            header_fields["Accept"] = accept
+        active_socket, header, received_data = self.send_friend_request(ip_address,
+                                                                        file_path,
+                                                                        modified_time=modified_time,
+                                                                        header_fields=header_fields)
+        try:
+            is_modified, content_type = self.check_header_for_modification_and_problems(header)
+        except (NotFriendException, ServerMissingFileException) as e:
+            active_socket.close()
+            raise e
+        with io.BytesIO() as friend_data_buffer:
+            try:
+                HTTP_Handler.retrieve_http_response_body_to_file(active_socket, friend_data_buffer, received_data)
+            except socket.timeout:
+                raise ServerUnavailableException
+            friend_data = friend_data_buffer.getvalue()
+        return friend_data, is_modified, content_type
+
+    # Sends a GET request to a friend server and reads the response header, leaving the body for the caller to read
+    def send_friend_request(self, ip_address, file_path, modified_time=None, header_fields=None):
+        if header_fields is None:
+            header_fields = {}
         if modified_time is not None:
             header_fields["If-Modified-Since"] = modified_time
         http_request = HTTP_Handler.generate_http_request('GET', file_path, header_fields)
         try:
-            active_socket = HTTP_Handler.send_http_request(http_request, ip_address, self.port)
-            header, friend_data = HTTP_Handler.retrieve_http_response(active_socket)
+            with Profile_Handler.span(f"request {file_path} from {ip_address}"):
+                active_socket = HTTP_Handler.send_http_request(http_request, ip_address, self.port)
+                header, received_data = HTTP_Handler.retrieve_http_response_header(active_socket)
         except (socket.timeout, ConnectionRefusedError):
             raise ServerUnavailableException
-        is_modified = self.check_header_for_modification_and_problems(header)
-        return friend_data, is_modified
+        return active_socket, header, received_data
 
     @staticmethod
     def check_header_for_modification_and_problems(header):
         status, header_fields = HTTP_Handler.parse_response_header(header)
+        content_type = header_fields.get('Content-Type')
         if "572" == status['code']:
             raise NotFriendException
         elif "404" == status['code']:
             raise ServerMissingFileException
         elif "304" == status['code']:
             # File has not been modified
-            return False
+            return False, content_type
         else:
             # File has been modified
-            return True
+            return True, content_type
 
     @staticmethod
-    def get_exception_status_element(status_text):
+    def get_exception_status(status_text):
         # This provides a blank status used if an exception occurs while attempting to get friend data
-        status_node = ET.fromstring("""
-        <status>
-        <timestamp></timestamp>
-        <status_text></status_text>
-        <likes />
-        </status>
-        """)
-        status_node.find("status_text").text = status_text
-        return status_node
-
-    def disable_button_if_already_liked(self, likes_element, friend_ip_address, friend_online):
+        return {'timestamp': None,
+                'status_text': status_text,
+                'likes': {'count': 0, 'ip_addresses': []}}
+
+    def disable_button_if_already_liked(self, like_ip_addresses, friend_ip_address, friend_online):
         s = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
         s.connect((friend_ip_address, self.port))
 
@@ -329,7 +454,7 @@ class DistributedSocialNetworkResponse:
         my_ip_address = s.getsockname()[0]
         s.close()
 
-        if self.is_ip_address_in_element(my_ip_address, likes_element) or not friend_online:
+        if my_ip_address in like_ip_addresses or not friend_online:
             return {'disabled': 'disabled'}
         else:
             return {}
@@ -346,8 +471,9 @@ class DistributedSocialNetworkResponse:
         friend_ip_address = self.data.pop('ip_address')
         http_request = HTTP_Handler.generate_http_request('POST', file_path, data=self.data)
         try:
-            active_socket = HTTP_Handler.send_http_request(http_request, friend_ip_address, self.port)
-            HTTP_Handler.retrieve_http_response(active_socket)
+            with Profile_Handler.span(f"send like to {friend_ip_address}"):
+                active_socket = HTTP_Handler.send_http_request(http_request, friend_ip_address, self.port)
+                HTTP_Handler.retrieve_http_response(active_socket)
         except socket.timeout:
             DistributedSocialNetworkResponse.logger.info('the server the user requested to like is unavailable')
 
@@ -368,7 +494,14 @@ class DistributedSocialNetworkResponse:
         # from adding additional likes before button is disabled
         if not self.is_ip_address_in_element(self.ip_address, liked_status.find('likes')):
             liked_status.find('likes').insert(0, liking_friend_element)
-            status_xml.write(status_xml_path_in_resources)
+            with Profile_Handler.span('write status.xml'):
+                status_xml.write(status_xml_path_in_resources)
+                self.write_statuses_json(status_xml.getroot())
+
+    def write_statuses_json(self, statuses_element):
+        # Keep the compact json version served to friend servers in step with status.xml
+        Status_Handler.write_statuses_json(statuses_element,
+                                           f"{self.resources_dir}{self.file_locations['status_json']}")
 
     def get_response(self):
         return self.response
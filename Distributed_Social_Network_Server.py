@@ -4,6 +4,7 @@ import xml.etree.ElementTree as ET
 
 from Distributed_Social_Network_Response import DistributedSocialNetworkResponse as DSN_response
 from basic_HTTP_server import Server
+import Status_Handler
 
 
 # Extends the server written for the tutorials
@@ -16,6 +17,7 @@ class DistributedSocialNetworkServer(Server):
             'friends_xml': 'friends.xml',
             'friends_html': 'friends.html',
             'status_xml': 'status.xml',
+            'status_json': 'status.json',
             'update_html': 'update.html',
             'profile_picture': 'profilePicture.jpg',
             'cached_friend_data_dir': 'cached_friend_profile_information'
@@ -24,6 +26,9 @@ class DistributedSocialNetworkServer(Server):
         # Delete cached info so that it forces a refresh
         self.delete_cached_friend_info()
 
+        # status.xml may have been edited while the server was down, so rebuild the json form served to friends
+        self.generate_statuses_json()
+
     def delete_cached_friend_info(self):
         cached_friend_data_dir_in_resources = f"{self.resources_dir}{self.file_locations['cached_friend_data_dir']}"
         if not os.path.isdir(cached_friend_data_dir_in_resources):
@@ -38,6 +43,27 @@ class DistributedSocialNetworkServer(Server):
             except Exception as e:
                 self.logger.debug('Failed to delete %s. Reason: %s' % (file_path, e))
 
+    def generate_statuses_json(self):
+        status_xml_path_in_resources = f"{self.resources_dir}{self.file_locations['status_xml']}"
+        status_json_path_in_resources = f"{self.resources_dir}{self.file_locations['status_json']}"
+        if os.path.isfile(status_xml_path_in_resources):
+            Status_Handler.write_statuses_json(ET.parse(status_xml_path_in_resources).getroot(),
+                                               status_json_path_in_resources)
+        elif os.path.isfile(status_json_path_in_resources):
+            # Left over from an earlier run, friends asking for json should get the same 404 as those asking for xml
+            os.remove(status_json_path_in_resources)
+
+    # Overrode method so that friend servers asking for json are given the compact version of status.xml. Browsers
+    # and older friend servers do not ask for json and keep receiving status.xml
+    def parse_header(self, request_header):
+        method, path, request_valid, header_fields = super().parse_header(request_header)
+        status_json_path_in_resources = f"{self.resources_dir}{self.file_locations['status_json']}"
+        if path == f"{self.resources_dir}{self.file_locations['status_xml']}" \
+                and Status_Handler.json_mime_type in header_fields.get('Accept', '') \
+                and os.path.isfile(status_json_path_in_resources):
+            path = status_json_path_in_resources
+        return method, path, request_valid, header_fields
+
     # Overrode method to introduce a new response for if the server refuses the connection because the user is not
     # on the friends list
     def get_response_status(self, path, request_valid, address, header_fields):
@@ -53,6 +79,11 @@ class DistributedSocialNetworkServer(Server):
             return False
         return True
 
+    # friends.html is generated for each request, so it has no stable bytes to take a range from
+    def is_range_supported(self, http_method, requested_path):
+        return super().is_range_supported(http_method, requested_path) \
+            and os.path.basename(requested_path) != self.file_locations['friends_html']
+
     def determine_response_body(self, http_method, requested_path, ip_address, data):
         return DSN_response(http_method,
                             requested_path,
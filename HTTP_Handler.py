@@ -52,6 +52,33 @@ def retrieve_http_response(receive_socket):
     return header, data
 
 
+# Reads only as far as the end of the header, so the body can be streamed somewhere other than memory
+def retrieve_http_response_header(receive_socket):
+    received_bytes = b''
+    max_bytes_per_receive = 1024
+    while b'\r\n\r\n' not in received_bytes:
+        received_data = receive_socket.recv(max_bytes_per_receive)
+        received_bytes += received_data
+        if len(received_data) == 0:
+            break
+    header, _, data = received_bytes.partition(b'\r\n\r\n')
+    return header, data
+
+
+def retrieve_http_response_body_to_file(receive_socket, file, received_data=b''):
+    max_bytes_per_receive = 65536
+    file.write(received_data)
+    try:
+        while True:
+            received_data = receive_socket.recv(max_bytes_per_receive)
+            # Assumes the socket will be closed by the other side
+            if len(received_data) == 0:
+                break
+            file.write(received_data)
+    finally:
+        receive_socket.close()
+
+
 def parse_response_header(header):
     header_str = header.decode('UTF-8')
 
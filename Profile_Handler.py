@@ -0,0 +1,203 @@
+import contextlib
+import cProfile
+import datetime
+import io
+import json
+import logging
+import os
+import pstats
+import random
+import shutil
+import threading
+import time
+
+
+# Spans of the request being handled by the current thread. Threads started while handling a request join the
+# request's span tree through propagate
+_local = threading.local()
+
+
+class Span:
+    def __init__(self, name):
+        self.name = name
+        self.thread_name = threading.current_thread().name
+        self.start_time = time.perf_counter()
+        self.end_time = None
+        self.children = []
+
+    def finish(self):
+        self.end_time = time.perf_counter()
+
+    def duration(self):
+        end_time = self.end_time if self.end_time is not None else time.perf_counter()
+        return end_time - self.start_time
+
+    def format_tree(self, depth=0):
+        lines = [f"{'    ' * depth}{self.duration() * 1000:9.2f} ms  {self.name}  [{self.thread_name}]"]
+        for child in list(self.children):
+            lines.extend(child.format_tree(depth + 1))
+        return lines
+
+
+def current_span():
+    return getattr(_local, 'span', None)
+
+
+# Does nothing when no request is being profiled, so it can be left around code permanently
+@contextlib.contextmanager
+def span(name):
+    parent = current_span()
+    if parent is None:
+        yield
+        return
+    child = Span(name)
+    parent.children.append(child)
+    _local.span = child
+    try:
+        yield
+    finally:
+        child.finish()
+        _local.span = parent
+
+
+def rename_current_span(name):
+    if current_span() is not None:
+        current_span().name = name
+
+
+@contextlib.contextmanager
+def attach(parent_span):
+    previous_span = current_span()
+    _local.span = parent_span
+    try:
+        yield
+    finally:
+        _local.span = previous_span
+
+
+# Wraps a function that will be run on another thread so that its spans are added to the current request
+def propagate(function, name):
+    parent_span = current_span()
+
+    def run_in_span(*args, **kwargs):
+        with attach(parent_span), span(name):
+            return function(*args, **kwargs)
+    return run_in_span
+
+
+class RequestProfiler:
+    logger = logging.getLogger('profiler')
+
+    default_settings = {
+        'enabled': False,
+        # Requests taking at least this long are always dumped
+        'latency_threshold_seconds': 1.0,
+        # Fraction of the remaining requests that are dumped regardless of how long they took
+        'sample_rate': 0.0,
+        'use_cprofile': True,
+        'profile_dir': 'request_profiles',
+        'max_profiles': 50
+    }
+
+    # The settings file is checked on every request, so profiling can be switched on and off by editing it while
+    # the server is running
+    def __init__(self, settings_path='profiler_settings.json'):
+        self.settings_path = settings_path
+        self.settings = dict(RequestProfiler.default_settings)
+        self.settings_modified_time = None
+        self.dump_lock = threading.Lock()
+
+    def reload_settings_if_changed(self):
+        try:
+            modified_time = os.path.getmtime(self.settings_path)
+        except OSError:
+            modified_time = None
+        if modified_time == self.settings_modified_time:
+            return
+
+        settings = dict(RequestProfiler.default_settings)
+        if modified_time is not None:
+            try:
+                with open(self.settings_path, 'r', encoding='UTF-8') as file:
+                    settings.update(self.validate_settings(json.load(file)))
+            except (OSError, ValueError, TypeError) as e:
+                # The modification time is not saved, so the file is tried again until it is fixed
+                RequestProfiler.logger.error('Failed to read %s, keeping previous settings. Reason: %s'
+                                             % (self.settings_path, e))
+                return
+        self.settings_modified_time = modified_time
+        self.settings = settings
+        RequestProfiler.logger.info('request profiling %s' % ('enabled' if settings['enabled'] else 'disabled'))
+
+    @staticmethod
+    def validate_settings(settings):
+        if not isinstance(settings, dict):
+            raise TypeError('settings must be a json object')
+        for key, number_types in [('latency_threshold_seconds', (int, float)),
+                                  ('sample_rate', (int, float)),
+                                  ('max_profiles', int)]:
+            if key in settings and (isinstance(settings[key], bool) or not isinstance(settings[key], number_types)):
+                raise TypeError(f"{key} must be a number")
+        if 'profile_dir' in settings and not isinstance(settings['profile_dir'], str):
+            raise TypeError('profile_dir must be a string')
+        return settings
+
+    @contextlib.contextmanager
+    def profile_request(self, name):
+        self.reload_settings_if_changed()
+        settings = self.settings
+        if not settings['enabled']:
+            yield
+            return
+
+        root_span = Span(name)
+        _local.span = root_span
+        profiler = None
+        if settings['use_cprofile']:
+            profiler = cProfile.Profile()
+            try:
+                profiler.enable()
+            except ValueError:
+                # Only one profiler can be active at a time on some python versions, the span tree is still recorded
+                profiler = None
+        try:
+            yield
+        finally:
+            if profiler is not None:
+                profiler.disable()
+            root_span.finish()
+            _local.span = None
+            if root_span.duration() >= settings['latency_threshold_seconds'] \
+                    or random.random() < settings['sample_rate']:
+                self.dump_profile(root_span, profiler, settings)
+
+    def dump_profile(self, root_span, profiler, settings):
+        profile_dir = settings['profile_dir']
+        timestamp = datetime.datetime.now().strftime('%Y%m%d-%H%M%S-%f')
+        safe_name = ''.join(character if character.isalnum() or character in '.-' else '_'
+                            for character in root_span.name)
+        request_profile_dir = os.path.join(profile_dir, f"{timestamp}_{threading.get_ident()}_{safe_name}")
+        try:
+            with self.dump_lock:
+                os.makedirs(request_profile_dir)
+                with open(os.path.join(request_profile_dir, 'spans.txt'), 'w', encoding='UTF-8') as file:
+                    file.write('\n'.join(root_span.format_tree()) + '\n')
+                if profiler is not None:
+                    profiler.dump_stats(os.path.join(request_profile_dir, 'profile.prof'))
+                    stats_stream = io.StringIO()
+                    pstats.Stats(profiler, stream=stats_stream).sort_stats('cumulative').print_stats(40)
+                    with open(os.path.join(request_profile_dir, 'profile.txt'), 'w', encoding='UTF-8') as file:
+                        file.write(stats_stream.getvalue())
+                self.remove_old_profiles(profile_dir, settings['max_profiles'])
+        except OSError as e:
+            RequestProfiler.logger.error('Failed to write profile %s. Reason: %s' % (request_profile_dir, e))
+            return
+        RequestProfiler.logger.info('%s took %.3fs, profile written to %s'
+                                    % (root_span.name, root_span.duration(), request_profile_dir))
+
+    @staticmethod
+    def remove_old_profiles(profile_dir, max_profiles):
+        # Directory names start with a timestamp so sorting them puts the oldest first
+        request_profile_dirs = sorted(os.listdir(profile_dir))
+        for old_profile_dir in request_profile_dirs[:max(len(request_profile_dirs) - max_profiles, 0)]:
+            shutil.rmtree(os.path.join(profile_dir, old_profile_dir), ignore_errors=True)
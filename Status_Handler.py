@@ -0,0 +1,55 @@
+import json
+import os
+import uuid
+
+
+json_mime_type = 'application/json'
+
+
+# Compact form of a status used for peer to peer exchange: likes are reduced to the set of liking ip addresses
+def status_element_to_dict(status_element):
+    like_ip_addresses = sorted({ip_address_element.text
+                                for ip_address_element in status_element.findall('likes//ip_address')})
+    return {'timestamp': status_element.find('timestamp').text,
+            'status_text': status_element.find('status_text').text,
+            'likes': {'count': len(like_ip_addresses), 'ip_addresses': like_ip_addresses}}
+
+
+def statuses_element_to_json(statuses_element):
+    statuses = [status_element_to_dict(status_element) for status_element in statuses_element.findall('status')]
+    return json.dumps({'statuses': statuses}, separators=(',', ':'))
+
+
+def write_statuses_json(statuses_element, json_path):
+    write_file_atomically(statuses_element_to_json(statuses_element), json_path)
+
+
+# Writes to a temporary file first so that a concurrent request never reads a half written file. Each writer gets its
+# own temporary file, so threads writing the same file at the same time cannot move each other's. The temporary file
+# is created with open like any other file, so it gets the same permissions as the files written in place
+def write_file_atomically(text, path):
+    temporary_path = os.path.join(os.path.dirname(path), f".{os.path.basename(path)}.{uuid.uuid4().hex}.tmp")
+    try:
+        with open(temporary_path, 'x', encoding='UTF-8') as file:
+            file.write(text)
+        os.replace(temporary_path, path)
+    finally:
+        if os.path.isfile(temporary_path):
+            os.remove(temporary_path)
+
+
+def statuses_from_json(statuses_json_bytes):
+    return json.loads(statuses_json_bytes.decode('UTF-8'))['statuses']
+
+
+def write_status_json(status, json_path):
+    write_file_atomically(json.dumps(status, separators=(',', ':')), json_path)
+
+
+def read_status_json(json_path):
+    with open(json_path, 'r', encoding='UTF-8') as file:
+        return json.load(file)
+
+
+def is_json_content_type(content_type):
+    return content_type is not None and content_type.split(';')[0].strip() == json_mime_type
@@ -1,5 +1,6 @@
 import os
 import datetime
+import calendar
 
 
 format_string = "%a, %d %b %Y %H:%M:%S GMT"
@@ -7,9 +8,13 @@ format_string = "%a, %d %b %Y %H:%M:%S GMT"
 
 # Conforms to the if-modified-since http standard
 def get_formatted_str_of_file_modification_time(file_path):
-    file_modified_timestamp = os.path.getmtime(file_path)
-    file_modified_datetime = datetime.datetime.utcfromtimestamp(file_modified_timestamp)
-    formatted_modified_datetime = file_modified_datetime.strftime(format_string)
+    return get_formatted_str_of_timestamp(os.path.getmtime(file_path))
+
+
+# Used with os.fstat so that the time matches a file that is already open, even if the path is replaced
+def get_formatted_str_of_timestamp(timestamp):
+    modified_datetime = datetime.datetime.utcfromtimestamp(timestamp)
+    formatted_modified_datetime = modified_datetime.strftime(format_string)
     return formatted_modified_datetime
 
 
@@ -17,3 +22,10 @@ def is_file_modified_since(check_string, test_string):
     check_datetime = datetime.datetime.strptime(check_string, format_string)
     test_datetime = datetime.datetime.strptime(test_string, format_string)
     return check_datetime > test_datetime
+
+
+# Used to give a downloaded file the modification time the server reported for it
+def set_file_modification_time(file_path, formatted_str):
+    modified_datetime = datetime.datetime.strptime(formatted_str, format_string)
+    modified_timestamp = calendar.timegm(modified_datetime.timetuple())
+    os.utime(file_path, (modified_timestamp, modified_timestamp))
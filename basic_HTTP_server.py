@@ -6,6 +6,7 @@ import urllib.parse
 import logging
 
 import Time_Handler
+import Profile_Handler
 
 
 class Server:
@@ -13,7 +14,9 @@ class Server:
                        "Not Found": "HTTP/1.1 404 Not Found",
                        "Not For You": "HTTP/1.1 571 Not For You",
                        "Bad Request": "HTTP/1.1 400 Bad Request",
-                       "Not Modified": "HTTP/1.1 304 Not Modified"}
+                       "Not Modified": "HTTP/1.1 304 Not Modified",
+                       "Partial Content": "HTTP/1.1 206 Partial Content",
+                       "Range Not Satisfiable": "HTTP/1.1 416 Range Not Satisfiable"}
 
     logger = logging.getLogger('server')
     logging.basicConfig(level=logging.INFO)
@@ -28,6 +31,9 @@ class Server:
         self.host_name = host_name
         self.server_socket = socket(AF_INET, SOCK_STREAM)
 
+        # Profiling is off until turned on in the settings file, which can be done while the server is running
+        self.profiler = Profile_Handler.RequestProfiler()
+
     def start(self):
         Server.logger.info((self.host_name, self.serverPort))
         # Bind the server socket to the port
@@ -59,8 +65,13 @@ class Server:
             Server.logger.debug("Started thread %r", thread)
 
     def respond_to_request(self, connection_socket, address):
+        with self.profiler.profile_request(address[0]):
+            self.handle_request(connection_socket, address)
+
+    def handle_request(self, connection_socket, address):
         # Retrieve the message sent by the client
-        request = connection_socket.recv(2048)
+        with Profile_Handler.span('receive request'):
+            request = connection_socket.recv(2048)
 
         # Stops issues from empty requests
         if request == '':
@@ -71,28 +82,50 @@ class Server:
         decoded_request = request.decode()
         http_method, requested_path, request_valid, header_fields = \
             self.parse_header(decoded_request.partition('\r\n\r\n')[0])
-        response_status = self.get_response_status(requested_path, request_valid, address[0], header_fields)
-        if response_status == 'OK' and http_method != 'HEAD':
+        Profile_Handler.rename_current_span(f"{http_method} {requested_path} from {address[0]}")
+        with Profile_Handler.span('determine response status'):
+            response_status = self.get_response_status(requested_path, request_valid, address[0], header_fields)
+
+        # Static files are sent straight from disk, which allows a client to ask for only part of one. The file is
+        # opened once so the headers and the body all describe the same file, even if the path is replaced meanwhile
+        static_file = None
+        byte_range = None
+        if response_status == 'OK' and self.is_range_supported(http_method, requested_path):
+            try:
+                static_file = open(requested_path, 'rb')
+                response_status, byte_range = self.determine_byte_range(http_method, static_file, header_fields)
+            except OSError:
+                response_status = 'Not Found'
+
+        if response_status in ['OK', 'Partial Content'] and http_method != 'HEAD':
             should_send_body = True
         else:
             should_send_body = False
 
         # Get data sent along with POST request
-        data = self.determine_data_if_post_request(http_method, decoded_request, connection_socket)
+        with Profile_Handler.span('receive post data'):
+            data = self.determine_data_if_post_request(http_method, decoded_request, connection_socket)
 
         Server.logger.debug('file requested: {}'.format(requested_path))
-        header_response = self.generate_header(response_status, requested_path)
+        header_response = self.generate_header(response_status, requested_path, byte_range, static_file)
 
         # Send HTTP response back to the client
         try:
-            connection_socket.send(header_response.encode())
-            if should_send_body:
-                connection_socket.send(self.determine_response_body(http_method,
-                                                                    requested_path,
-                                                                    address[0],
-                                                                    data))
+            with Profile_Handler.span('send header'):
+                connection_socket.send(header_response.encode())
+            if should_send_body and byte_range is not None:
+                with Profile_Handler.span('send file'):
+                    self.send_file_range(connection_socket, static_file, byte_range)
+            elif should_send_body:
+                with Profile_Handler.span('determine response body'):
+                    response_body = self.determine_response_body(http_method, requested_path, address[0], data)
+                with Profile_Handler.span('send body'):
+                    connection_socket.send(response_body)
         except OSError:
             Server.logger.error('send interrupted')
+        finally:
+            if static_file is not None:
+                static_file.close()
 
         # Close the connection
         connection_socket.close()
@@ -103,6 +136,60 @@ class Server:
             response = file.read()
         return response
 
+    # Overridden by servers that generate some files dynamically, those cannot be sent in ranges
+    def is_range_supported(self, http_method, requested_path):
+        return http_method in ['GET', 'HEAD']
+
+    @staticmethod
+    def determine_byte_range(http_method, file, header_fields):
+        file_stat = os.fstat(file.fileno())
+        file_size = file_stat.st_size
+        full_range = (0, file_size - 1)
+
+        # Range must be ignored for anything other than GET, so HEAD describes the whole file. Only a single range is
+        # supported, otherwise the whole file is sent which is allowed by the standard
+        range_str = header_fields.get('Range', '')
+        if http_method != 'GET' or not range_str.startswith('bytes=') or ',' in range_str:
+            return 'OK', full_range
+
+        # If the file has changed since the client got the first part, the client needs all of the new file
+        if 'If-Range' in header_fields and \
+                header_fields['If-Range'] != Time_Handler.get_formatted_str_of_timestamp(file_stat.st_mtime):
+            return 'OK', full_range
+
+        start_str, _, end_str = range_str[len('bytes='):].strip().partition('-')
+        try:
+            if start_str == '':
+                # Suffix range, asking for the last bytes of the file
+                suffix_length = int(end_str)
+                if suffix_length < 0:
+                    return 'OK', full_range
+                start = max(file_size - suffix_length, 0)
+                end = file_size - 1 if suffix_length > 0 else -1
+            else:
+                start = int(start_str)
+                if end_str == '':
+                    end = file_size - 1
+                elif int(end_str) < start:
+                    # Not a valid range, so it is ignored rather than being unsatisfiable
+                    return 'OK', full_range
+                else:
+                    end = min(int(end_str), file_size - 1)
+        except ValueError:
+            return 'OK', full_range
+
+        if start > end or start >= file_size:
+            return 'Range Not Satisfiable', None
+        return 'Partial Content', (start, end)
+
+    @staticmethod
+    def send_file_range(connection_socket, file, byte_range):
+        start, end = byte_range
+        if end < start:
+            # Empty file
+            return
+        connection_socket.sendfile(file, offset=start, count=end - start + 1)
+
     @staticmethod
     def determine_data_if_post_request(http_method, decoded_request, connection_socket):
         if http_method == 'POST':
@@ -164,16 +251,33 @@ class Server:
         else:
             return 'Not Found'
 
-    def generate_header(self, response_status, path):
+    def generate_header(self, response_status, path, byte_range=None, static_file=None):
         status_line = self.header_statuses[response_status] + '\r\n'
-        if response_status in ['OK', 'Not Modified']:
+        # Files opened to be sent are described from the open file, so the headers match the bytes that are sent
+        if static_file is not None:
+            file_stat = os.fstat(static_file.fileno())
+            file_size = file_stat.st_size
+            modified_time = Time_Handler.get_formatted_str_of_timestamp(file_stat.st_mtime)
+        else:
+            file_size = None
+            modified_time = None
+        if response_status in ['OK', 'Not Modified', 'Partial Content']:
             mime_type = mimetypes.guess_type(os.path.basename(path))[0]
+            if modified_time is None:
+                modified_time = Time_Handler.get_formatted_str_of_file_modification_time(path)
             additional_header_lines = "Content-Type: " + mime_type + '\r\n'
-            additional_header_lines += "Last-Modified: " +\
-                                       Time_Handler.get_formatted_str_of_file_modification_time(path) + '\r\n'
+            additional_header_lines += "Last-Modified: " + modified_time + '\r\n'
             # html may be generated dynamically, should not be cached for this server
-            if 'html' in mime_type or 'xml' in mime_type:
+            if 'html' in mime_type or 'xml' in mime_type or 'json' in mime_type:
                 additional_header_lines += "Cache-Control: no-store\r\n"
+            if byte_range is not None:
+                start, end = byte_range
+                additional_header_lines += "Accept-Ranges: bytes\r\n"
+                additional_header_lines += f"Content-Length: {end - start + 1}\r\n"
+                if response_status == 'Partial Content':
+                    additional_header_lines += f"Content-Range: bytes {start}-{end}/{file_size}\r\n"
+        elif response_status == 'Range Not Satisfiable':
+            additional_header_lines = f"Content-Range: bytes */{file_size}\r\n"
         else:
             additional_header_lines = ''
         return status_line + additional_header_lines + '\r\n'